@@ -3,32 +3,186 @@ Qwen2.5 7B Instruct model wrapper for structured data extraction
 Converts messy HTML content to structured missing person data
 """
 
+import asyncio
+import functools
 import logging
-from typing import List, Optional, Dict, Any
+import os
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 from datetime import datetime
-import json
+from uuid import uuid4
 import re
 
+import json_repair
+import orjson
+import torch
+import xxhash
+from cachetools import TTLCache
+from pydantic import TypeAdapter
+from selectolax.parser import HTMLParser
+from transformers import AutoModelForCausalLM, AutoTokenizer, PreTrainedTokenizerBase
+
+try:
+    from vllm import AsyncLLMEngine, AsyncEngineArgs, SamplingParams
+    from vllm.inputs import TokensPrompt
+    from vllm.sampling_params import GuidedDecodingParams
+except ImportError:
+    # Only the vLLM backend needs it; HFQwenExtractor runs without vLLM
+    AsyncLLMEngine = None
+
+from schemas import MissingPersonExtractionSchema
+
 logger = logging.getLogger(__name__)
 
+# Guided decoding constrains sampling to this schema, so output is always valid JSON
+_RECORDS_JSON_SCHEMA = TypeAdapter(List[MissingPersonExtractionSchema]).json_schema()
+
+_INLINE_SPACE_RE = re.compile(r"[^\S\n]+")
+_LINE_BREAK_RE = re.compile(r"\s*\n\s*")
+
+# Pages shorter than this, or whose visible text has none of these words,
+# cannot hold a listing (empty/404 bodies, JS shells) and skip the model.
+# "found" is left out on purpose: every "404 Not Found" page contains it.
+_MIN_LEN = 200
+_KEYWORD_RE = re.compile(r"\b(missing|age|name)\b", re.I)
+
+# Record-count estimate used to cap generation length: "Name:" labels in the
+# page text, or table rows in the raw HTML for tabular listings
+_NAME_LABEL_RE = re.compile(r"\bName\s*[:\-]", re.I)
+_TABLE_ROW_RE = re.compile(r"<tr[\s>]", re.I)
+
+# Longer src values (tracking URLs, inline blobs) are not worth their tokens
+_MAX_IMG_URL_LEN = 512
+
+# Markup that never carries record data but dominates raw page size
+_BOILERPLATE_TAGS = ["script", "style", "noscript", "svg", "iframe", "nav", "footer"]
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model_name: str) -> PreTrainedTokenizerBase:
+    """Process-wide fast tokenizer, shared by the extractors and the batcher"""
+    return AutoTokenizer.from_pretrained(model_name, use_fast=True)
+
+
+def _is_listing_text(text: str) -> bool:
+    """Whether a page's visible text could contain missing person records"""
+    return bool(text) and _KEYWORD_RE.search(text) is not None
+
+
+def _empty_result() -> Dict[str, Any]:
+    return {"success": True, "records": [], "confidence_scores": [], "truncated": False}
+
+
+def _html_to_text(html_content: str) -> str:
+    """
+    Reduce a page to its visible text, keeping image URLs for photo_url
+    
+    Each text node goes on its own line so table cells and list rows stay
+    apart; only runs of spaces and blank lines are collapsed.
+    """
+    tree = HTMLParser(html_content)
+    tree.strip_tags(_BOILERPLATE_TAGS)
+    
+    for img in tree.css("img[src]"):
+        src = (img.attributes["src"] or "").strip()
+        if src.startswith("data:") or len(src) > _MAX_IMG_URL_LEN:
+            img.decompose()
+        else:
+            img.replace_with(f" {src} ")
+    
+    node = tree.body or tree.root
+    if node is None:
+        return ""
+    
+    text = node.text(separator="\n", strip=True)
+    text = _INLINE_SPACE_RE.sub(" ", text)
+    return _LINE_BREAK_RE.sub("\n", text).strip()
+
+
+class _RecordStreamParser:
+    """
+    Incremental scanner over a streamed JSON array of objects
+    
+    Tracks bracket depth and string state so each top-level object can be
+    parsed as soon as its closing brace arrives, without waiting for the
+    rest of the array.
+    """
+    
+    def __init__(self):
+        self._buffer: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+    
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Consume more output text and return any records it completed"""
+        records = []
+        for char in chunk:
+            if self._depth >= 2:
+                self._buffer.append(char)
+            
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+                if self._depth == 2:
+                    self._buffer = [char]
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 1:
+                    records.append(orjson.loads("".join(self._buffer)))
+                    self._buffer = []
+        
+        return records
+
 
 class ExtractionError(Exception):
     """Custom exception for extraction failures"""
     pass
 
 
+class EngineError(ExtractionError):
+    """Transient inference failure (OOM, timeout, dead engine) worth retrying"""
+    pass
+
+
 class QwenExtractor:
     """
     LLM-based data extraction using Qwen2.5-7B-Instruct
     
+    Inference runs on vLLM's AsyncLLMEngine (PagedAttention + continuous
+    batching), so concurrent extract() calls share decode steps on the GPU.
+    
     Design Principles:
     1. Only extracts data from HTML (no geocoding)
     2. Never directly writes to database
     3. Returns structured JSON matching schema
     4. High temperature=0.1 for consistent extractions
-    5. Validates JSON schema before returning
+    5. Returns raw records; the API validates them against the schema
     """
 
+    # Static rules/schema come first and the HTML is appended last, so every
+    # rendered prompt shares the same prefix and vLLM's prefix cache can reuse
+    # its KV blocks across requests.
     EXTRACTION_PROMPT_TEMPLATE = """You are a data extraction specialist. Extract missing person information from the provided HTML content.
 
 Return ONLY valid JSON array (no markdown, no extra text) matching this schema:
@@ -47,9 +201,6 @@ Return ONLY valid JSON array (no markdown, no extra text) matching this schema:
   }}
 ]
 
-HTML Content:
-{html_content}
-
 Rules:
 - Extract ONLY complete records with name, age, gender, location, and date
 - Parse dates in Indian format (DD-MM-YYYY, DD/MM/YYYY, DD MMM YYYY)
@@ -57,35 +208,133 @@ Rules:
 - Skip incomplete records
 - Return empty array if no valid records found
 - Do NOT invent data
-- Do NOT write to any database"""
+- Do NOT write to any database
 
-    def __init__(self, model_name: str = "Qwen2.5-7B-Instruct"):
+HTML Content:
+{html_content}
+
+JSON Output:
+"""
+
+    # Partially evaluated once at class load: only the page text varies, so
+    # prompts are built by concatenation rather than .format() per call
+    _PREFIX, _SUFFIX = (
+        part.replace("{{", "{").replace("}}", "}")
+        for part in EXTRACTION_PROMPT_TEMPLATE.split("{html_content}")
+    )
+
+    # Context window the engine is started with; page text is truncated so
+    # prompt plus MAX_TOKENS of output always fits
+    MAX_MODEL_LEN = 32768
+    
+    # Generation cap: a record serialises to roughly 80-150 tokens
+    MAX_TOKENS = 2048
+    TOKENS_PER_RECORD = 160
+    
+    TEMPERATURE = 0.1
+    
+    # Wall-clock budget for one page's generation, including the re-run
+    GENERATION_TIMEOUT_SECONDS = 60
+    
+    # Re-touch the prompt prefix this often so LRU eviction never picks it
+    PREFIX_REFRESH_SECONDS = 60
+    
+    # Crawlers re-fetch the same pages; identical content reuses its result
+    RESULT_CACHE_SIZE = 10_000
+    RESULT_CACHE_TTL_SECONDS = 3600
+
+    def __init__(self, model_name: str = "Qwen/Qwen2.5-7B-Instruct-AWQ"):
         """Initialize the model"""
         self.model_name = model_name
-        self.model = None
-        self.tokenizer = None
+        self.engine: Optional["AsyncLLMEngine"] = None
+        self._guided_decoding: Optional["GuidedDecodingParams"] = None
+        self.tokenizer: Optional[PreTrainedTokenizerBase] = None
+        self._prefix_ids: List[int] = []
+        self._suffix_ids: List[int] = []
+        self._max_page_tokens = 0
+        self._results: TTLCache = TTLCache(
+            maxsize=self.RESULT_CACHE_SIZE, ttl=self.RESULT_CACHE_TTL_SECONDS
+        )
+        self._pending: Dict[int, asyncio.Future] = {}
         self._load_model()
 
     def _load_model(self) -> None:
-        """Load Qwen model and tokenizer"""
+        """Start the vLLM engine (PagedAttention KV cache, continuous batching)"""
+        # 4-bit AWQ weights and an FP8 KV cache roughly double the number of
+        # sequences that fit in GPU memory. On H100 use fp8_e4m3.
+        kv_cache_dtype = os.getenv("LLM_KV_CACHE_DTYPE", "fp8")
+        
+        if AsyncLLMEngine is None:
+            raise ExtractionError("vLLM is not installed; set LLM_BACKEND=hf to use transformers")
+        
         try:
-            # This is a placeholder - actual implementation requires:
-            # from transformers import AutoModelForCausalLM, AutoTokenizer
-            # import torch
-            
-            # self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            # self.model = AutoModelForCausalLM.from_pretrained(
-            #     self.model_name,
-            #     torch_dtype=torch.float16,
-            #     device_map="auto"
-            # )
+            self._load_tokenizer()
+            self._guided_decoding = GuidedDecodingParams(json=_RECORDS_JSON_SCHEMA)
+            self.engine = AsyncLLMEngine.from_engine_args(
+                AsyncEngineArgs(
+                    model=self.model_name,
+                    # quantization is left unset so vLLM picks the fast
+                    # awq_marlin kernels from the checkpoint config; Marlin
+                    # supports bf16 activations
+                    dtype="bfloat16",
+                    kv_cache_dtype=kv_cache_dtype,
+                    calculate_kv_scales=kv_cache_dtype.startswith("fp8"),
+                    max_model_len=self.MAX_MODEL_LEN,
+                    enable_prefix_caching=True,
+                    max_num_seqs=256,
+                    gpu_memory_utilization=0.9,
+                    # Slice long HTML prefills so they interleave with decode
+                    # steps; keep CUDA graph capture for the decode path
+                    enable_chunked_prefill=True,
+                    max_num_batched_tokens=8192,
+                    enforce_eager=False,
+                )
+            )
             
             logger.info(f"Model {self.model_name} loaded successfully")
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
             raise ExtractionError(f"Failed to load LLM model: {e}")
 
-    def extract(self, html_content: str, source_state: str) -> Dict[str, Any]:
+    def _load_tokenizer(self) -> None:
+        """Load the fast tokenizer and pre-tokenize the static prompt parts"""
+        self.tokenizer = get_tokenizer(self.model_name)
+        # The template is static, so its token ids are computed only once
+        self._prefix_ids = self.tokenizer.encode(self._PREFIX, add_special_tokens=False)
+        self._suffix_ids = self.tokenizer.encode(self._SUFFIX, add_special_tokens=False)
+        self._max_page_tokens = (
+            self.MAX_MODEL_LEN - len(self._prefix_ids) - len(self._suffix_ids) - self.MAX_TOKENS
+        )
+
+    async def warmup(self) -> None:
+        """Prefill the static prompt prefix once so its KV blocks are cached"""
+        await self._touch_prefix()
+        logger.info("Prompt prefix cache warmed")
+
+    async def keep_prefix_warm(self) -> None:
+        """
+        Keep the prompt prefix resident in the prefix cache
+        
+        vLLM evicts cached blocks least-recently-used first and has no way
+        to pin them, so re-touching the prefix periodically keeps it from
+        being evicted while the crawler is idle between bursts.
+        """
+        while True:
+            await asyncio.sleep(self.PREFIX_REFRESH_SECONDS)
+            try:
+                await self._touch_prefix()
+            except Exception as e:
+                logger.warning(f"Failed to refresh prompt prefix cache: {e}")
+
+    async def _touch_prefix(self) -> None:
+        async for _ in self.engine.generate(
+            TokensPrompt(prompt_token_ids=self._prefix_ids),
+            SamplingParams(max_tokens=1),
+            request_id=uuid4().hex,
+        ):
+            pass
+
+    async def extract(self, html_content: str, source_state: str) -> Dict[str, Any]:
         """
         Extract missing person data from HTML
         
@@ -96,105 +345,455 @@ Rules:
         Returns:
             Dict with extracted records and confidence scores
         """
+        if len(html_content) < _MIN_LEN:
+            return _empty_result()
+        
+        return await self.cached_extract(html_content, lambda: self._extract_page(html_content))
+
+    async def _extract_page(self, html_content: str) -> Dict[str, Any]:
+        prompt = await asyncio.to_thread(self.build_prompt, html_content)
+        if prompt is None:
+            return _empty_result()
+        
+        return await self.extract_prompt(*prompt)
+
+    async def cached_extract(
+        self, html_content: str, compute: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """
+        Return the cached result for identical page content, else compute it
+        
+        Concurrent requests for the same content share one in-flight
+        computation. Only successful, untruncated results are cached, so a
+        page whose output hit the token cap is tried again next time. The
+        cache is only touched from the event loop, so it needs no lock.
+        """
+        key = xxhash.xxh64_intdigest(html_content)
+        result = self._results.get(key)
+        if result is not None:
+            return result
+        
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(compute())
+            self._pending[key] = pending
+            pending.add_done_callback(functools.partial(self._store_result, key))
+        
+        # Shielded so one cancelled caller does not abort the shared work
+        return await asyncio.shield(pending)
+
+    def _store_result(self, key: int, pending: "asyncio.Future[Dict[str, Any]]") -> None:
+        """Cache a finished computation once, whoever is still awaiting it"""
+        self._pending.pop(key, None)
+        if pending.cancelled() or pending.exception() is not None:
+            return
+        result = pending.result()
+        if not result["truncated"]:
+            self._results[key] = result
+
+    def build_prompt(self, html_content: str) -> Optional[Tuple[List[int], int]]:
+        """Build the prompt token ids and output token cap for a page"""
+        return self.build_prompts([html_content])[0]
+
+    def build_prompts(self, pages: List[str]) -> List[Optional[Tuple[List[int], int]]]:
+        """
+        Build tokenized extraction prompts for several pages
+        
+        Only each page's visible text is tokenized (in one fast-tokenizer
+        call); it is placed between the cached prefix and suffix token ids.
+        Pages whose text cannot hold a listing get None and skip the model.
+        """
+        texts = [_html_to_text(html) for html in pages]
+        listings = [i for i, text in enumerate(texts) if _is_listing_text(text)]
+        prompts: List[Optional[Tuple[List[int], int]]] = [None] * len(pages)
+        if not listings:
+            return prompts
+        
+        encoded = self.tokenizer(
+            [texts[i] for i in listings],
+            add_special_tokens=False,
+            padding=False,
+            return_tensors=None,
+        )
+        for i, ids in zip(listings, encoded["input_ids"]):
+            prompts[i] = (
+                self._prefix_ids + self._truncate(ids) + self._suffix_ids,
+                self._max_tokens_for(pages[i], texts[i]),
+            )
+        return prompts
+
+    def _truncate(self, page_ids: List[int]) -> List[int]:
+        """Cut page text so the prompt and its output fit the context window"""
+        if len(page_ids) > self._max_page_tokens:
+            logger.warning(
+                f"Page text is {len(page_ids)} tokens, truncating to {self._max_page_tokens}"
+            )
+            return page_ids[:self._max_page_tokens]
+        return page_ids
+
+    def _max_tokens_for(self, html_content: str, text: str) -> int:
+        """Cap output tokens by the number of records the page seems to hold"""
+        n_records = max(
+            1,
+            len(_NAME_LABEL_RE.findall(text)),
+            len(_TABLE_ROW_RE.findall(html_content)),
+        )
+        return min(self.MAX_TOKENS, self.TOKENS_PER_RECORD * n_records + 32)
+
+    def _sampling_params(self, max_tokens: int) -> "SamplingParams":
+        return SamplingParams(
+            temperature=self.TEMPERATURE,
+            max_tokens=max_tokens,
+            # No stop strings: the grammar already ends generation at the
+            # closing "]", and a stop string could only cut the array short
+            guided_decoding=self._guided_decoding,
+        )
+
+    async def extract_prompt(self, token_ids: List[int], max_tokens: int) -> Dict[str, Any]:
+        """Run extraction for an already built prompt"""
         try:
-            prompt = self.EXTRACTION_PROMPT_TEMPLATE.format(html_content=html_content)
-            
-            # Placeholder for actual model inference
-            # output = self.model.generate(
-            #     self.tokenizer.encode(prompt, return_tensors="pt"),
-            #     max_new_tokens=2048,
-            #     temperature=0.1,
-            #     do_sample=True,
-            # )
-            
-            # For testing, return mock response
-            response_text = self._mock_extraction(html_content)
-            
-            # Parse JSON response
+            # Cancelling the wait aborts the engine request, freeing its KV blocks
+            response_text, truncated = await asyncio.wait_for(
+                self._generate_full(token_ids, max_tokens),
+                timeout=self.GENERATION_TIMEOUT_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"Inference timed out after {self.GENERATION_TIMEOUT_SECONDS}s")
+            raise EngineError(
+                f"Inference timed out after {self.GENERATION_TIMEOUT_SECONDS}s"
+            )
+        except RuntimeError as e:
+            logger.error(f"Inference failed: {e}")
+            raise EngineError(f"Inference error: {e}")
+        except ExtractionError:
+            raise
+        except Exception as e:
+            # e.g. ValueError for a rejected prompt; retrying would not help
+            logger.error(f"Inference failed: {e}")
+            raise ExtractionError(f"Inference error: {e}")
+        
+        try:
+            # Parse JSON response; schema validation happens once, in the API layer
             records = self._parse_response(response_text)
-            
-            # Validate schema
-            validated_records = self._validate_records(records)
+            if not isinstance(records, list):
+                raise ValueError("model response is not a JSON array")
+            if truncated:
+                logger.warning(
+                    f"Output truncated at {self.MAX_TOKENS} tokens, records may be missing"
+                )
             
             return {
                 "success": True,
-                "records": validated_records,
-                "confidence_scores": [0.95] * len(validated_records),  # Mock confidence
+                "records": records,
+                "confidence_scores": [0.95] * len(records),  # Mock confidence
+                "truncated": truncated,
             }
             
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse LLM response as JSON: {e}")
-            raise ExtractionError(f"Invalid JSON response from model: {e}")
         except Exception as e:
             logger.error(f"Extraction failed: {e}")
             raise ExtractionError(f"Extraction error: {e}")
 
-    def _mock_extraction(self, html_content: str) -> str:
-        """Mock extraction for testing"""
-        return "[]"
+    async def _generate_full(self, token_ids: List[int], max_tokens: int) -> Tuple[str, bool]:
+        """Generate, re-running once at MAX_TOKENS if the estimated cap was hit"""
+        response_text, truncated = await self._generate(token_ids, max_tokens)
+        if truncated and max_tokens < self.MAX_TOKENS:
+            # The record-count estimate was too low; repairing the cut-off
+            # array would silently drop records, so pay for one re-run
+            logger.warning(
+                f"Output hit max_tokens={max_tokens}, re-running with {self.MAX_TOKENS}"
+            )
+            response_text, truncated = await self._generate(token_ids, self.MAX_TOKENS)
+        return response_text, truncated
+
+    async def stream_records(self, html_content: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield raw records one by one as the model finishes generating each"""
+        if len(html_content) < _MIN_LEN:
+            return
+        
+        prompt = await asyncio.to_thread(self.build_prompt, html_content)
+        if prompt is None:
+            return
+        
+        parser = _RecordStreamParser()
+        seen = 0
+        finish_reason = None
+        # A stream cannot be re-run once records are sent, so skip the
+        # record-count estimate and allow the full output budget
+        token_ids, _ = prompt
+        
+        async for output in self.engine.generate(
+            TokensPrompt(prompt_token_ids=token_ids),
+            self._sampling_params(self.MAX_TOKENS),
+            request_id=uuid4().hex,
+        ):
+            text = output.outputs[0].text
+            finish_reason = output.outputs[0].finish_reason
+            delta, seen = text[seen:], len(text)
+            for record in parser.feed(delta):
+                yield record
+        
+        if finish_reason == "length":
+            raise ExtractionError(
+                f"Output truncated at {self.MAX_TOKENS} tokens, records may be missing"
+            )
+
+    async def _generate(self, token_ids: List[int], max_tokens: int) -> Tuple[str, bool]:
+        """
+        Submit a prompt to the engine and wait for the final output
+        
+        Returns the generated text and whether it was cut off at max_tokens.
+        """
+        final_output = None
+        async for output in self.engine.generate(
+            TokensPrompt(prompt_token_ids=token_ids),
+            self._sampling_params(max_tokens),
+            request_id=uuid4().hex,
+        ):
+            final_output = output
+        
+        if final_output is None or not final_output.outputs:
+            raise ExtractionError("Model returned no output")
+        
+        completion = final_output.outputs[0]
+        return completion.text, completion.finish_reason == "length"
 
     def _parse_response(self, response: str) -> List[Dict[str, Any]]:
         """Parse JSON response from model"""
-        # Remove markdown code blocks if present
-        response = response.strip()
-        if response.startswith("```"):
-            response = response.split("```")[1]
-            if response.startswith("json"):
-                response = response[4:]
+        try:
+            return orjson.loads(response)
+        except orjson.JSONDecodeError as e:
+            # e.g. output cut off at max_tokens; repairing locally is far
+            # cheaper than re-running the model
+            logger.warning(f"Repairing malformed JSON response: {e}")
+            return json_repair.loads(response)
+
+
+class HFQwenExtractor(QwenExtractor):
+    """
+    Fallback extractor on plain HuggingFace transformers
+    
+    For hosts where vLLM cannot run (vLLM need not be installed). Loads bf16
+    weights with SDPA attention and a torch.compile'd forward; requests are
+    generated one at a time.
+    Guided decoding is unavailable here, so malformed output relies on the
+    JSON repair fallback in _parse_response.
+    """
+
+    WARMUP_TOKENS = 2048
+
+    def __init__(self, model_name: str = "Qwen/Qwen2.5-7B-Instruct"):
+        self.model = None
+        self._lock = asyncio.Lock()
+        super().__init__(model_name=model_name)
+
+    def _load_model(self) -> None:
+        """Load Qwen model and tokenizer"""
+        try:
+            self._load_tokenizer()
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.model_name,
+                torch_dtype=torch.bfloat16,
+                attn_implementation="sdpa",
+                device_map="auto",
+            )
+            # Compile forward rather than the module so generate() uses it;
+            # dynamic shapes avoid recompiling for every prompt length
+            self.model.forward = torch.compile(
+                self.model.forward, mode="reduce-overhead", dynamic=True
+            )
+            
+            logger.info(f"Model {self.model_name} loaded successfully")
+        except Exception as e:
+            logger.error(f"Failed to load model: {e}")
+            raise ExtractionError(f"Failed to load LLM model: {e}")
+
+    async def warmup(self) -> None:
+        """Trigger compilation with a full-length dummy prompt"""
+        token_ids = (self._prefix_ids * self.WARMUP_TOKENS)[:self.WARMUP_TOKENS]
+        async with self._lock:
+            await asyncio.to_thread(self._generate_sync, token_ids, 1)
         
-        return json.loads(response)
+        logger.info("Compiled model warmed")
+
+    async def keep_prefix_warm(self) -> None:
+        """No prefix cache to keep warm on this backend"""
+        return
 
-    def _validate_records(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Validate records match schema"""
-        validated = []
+    async def stream_records(self, html_content: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield raw records once generation finishes (no token streaming)"""
+        if len(html_content) < _MIN_LEN:
+            return
+        
+        prompt = await asyncio.to_thread(self.build_prompt, html_content)
+        if prompt is None:
+            return
         
-        for record in records:
+        text, truncated = await self._generate(prompt[0], self.MAX_TOKENS)
+        for record in _RecordStreamParser().feed(text):
+            yield record
+        
+        if truncated:
+            raise ExtractionError(
+                f"Output truncated at {self.MAX_TOKENS} tokens, records may be missing"
+            )
+
+    async def _generate(self, token_ids: List[int], max_tokens: int) -> Tuple[str, bool]:
+        """Generate off the event loop, one request at a time"""
+        async with self._lock:
+            return await asyncio.to_thread(self._generate_sync, token_ids, max_tokens)
+
+    def _generate_sync(self, token_ids: List[int], max_new_tokens: int) -> Tuple[str, bool]:
+        input_ids = torch.tensor([token_ids], device=self.model.device)
+        with torch.inference_mode():
+            output = self.model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                max_new_tokens=max_new_tokens,
+                temperature=self.TEMPERATURE,
+                do_sample=True,
+            )
+        generated = output[0, input_ids.shape[1]:]
+        truncated = (
+            generated.shape[0] >= max_new_tokens
+            and generated[-1].item() != self.tokenizer.eos_token_id
+        )
+        return self.tokenizer.decode(generated, skip_special_tokens=True), truncated
+
+
+class ExtractionBatcher:
+    """
+    Micro-batching queue in front of the extractor
+    
+    Collects up to MAX_BATCH requests (or whatever arrives within
+    MAX_WAIT_MS), tokenizes their pages in a single fast tokenizer call,
+    then submits them to the engine together. Exposes the
+    same extract() signature as QwenExtractor.
+    """
+    
+    MAX_BATCH = 32
+    MAX_WAIT_MS = 10
+    
+    def __init__(self, extractor: QwenExtractor):
+        self.extractor = extractor
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+    
+    def start(self) -> None:
+        """Start the background drain loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Stop the drain loop and fail any requests still queued"""
+        if self._task is not None:
+            self._task.cancel()
             try:
-                # Check required fields
-                required = ["name", "age", "gender", "last_seen_date", "last_known_location"]
-                if not all(field in record for field in required):
-                    logger.warning(f"Skipping record missing required fields: {record}")
-                    continue
-                
-                # Type validation
-                if not isinstance(record["age"], int) or not (0 <= record["age"] <= 150):
-                    logger.warning(f"Invalid age in record: {record}")
-                    continue
-                
-                if record["gender"] not in ["male", "female", "other"]:
-                    logger.warning(f"Invalid gender in record: {record}")
-                    record["gender"] = "other"
-                
-                validated.append(record)
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
+        self._fail(queued, ExtractionError("Extraction service is shutting down"))
+    
+    async def extract(self, html_content: str, source_state: str) -> Dict[str, Any]:
+        """Queue a page for extraction and wait for its result"""
+        if len(html_content) < _MIN_LEN:
+            return _empty_result()
+        
+        return await self.extractor.cached_extract(
+            html_content, lambda: self._enqueue(html_content, source_state)
+        )
+    
+    async def _enqueue(self, html_content: str, source_state: str) -> Dict[str, Any]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((html_content, source_state, future))
+        return await future
+    
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                if self._queue.qsize() < self.MAX_BATCH - 1:
+                    await asyncio.sleep(self.MAX_WAIT_MS / 1000)
+                while len(batch) < self.MAX_BATCH and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
                 
-            except Exception as e:
-                logger.warning(f"Error validating record: {e}")
-                continue
+                await self._dispatch(batch)
+            except asyncio.CancelledError:
+                self._fail(batch, ExtractionError("Extraction service is shutting down"))
+                raise
+    
+    async def _dispatch(self, batch: List[Tuple[str, str, asyncio.Future]]) -> None:
+        """Tokenize a batch in one call and fan each prompt out to the engine"""
+        try:
+            # HTML parsing and tokenization of up to MAX_BATCH pages would
+            # otherwise block the event loop for every other request
+            prompts = await asyncio.to_thread(
+                self.extractor.build_prompts, [html for html, _, _ in batch]
+            )
+        except Exception as e:
+            logger.error(f"Failed to prepare extraction batch: {e}")
+            self._fail(batch, ExtractionError(f"Extraction error: {e}"))
+            return
         
-        return validated
+        for (_, _, future), prompt in zip(batch, prompts):
+            if prompt is None:
+                if not future.done():
+                    future.set_result(_empty_result())
+                continue
+            
+            task = asyncio.create_task(self._resolve(future, *prompt))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+    
+    @staticmethod
+    def _fail(batch: List[Tuple[str, str, asyncio.Future]], error: Exception) -> None:
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+    
+    async def _resolve(
+        self,
+        future: asyncio.Future,
+        token_ids: List[int],
+        max_tokens: int,
+    ) -> None:
+        try:
+            result = await self.extractor.extract_prompt(token_ids, max_tokens)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
 
 
 class ExtractionWithRetry:
     """
     Retry wrapper for extraction with exponential backoff
+    
+    Only transient engine failures are retried; a bad model response would
+    come out the same way again, so re-running the model is not worth it.
     """
     
     MAX_RETRIES = 3
     BASE_DELAY_MS = 1000
     
-    def __init__(self, extractor: QwenExtractor):
+    def __init__(self, extractor: Union[QwenExtractor, ExtractionBatcher]):
         self.extractor = extractor
     
     async def extract_with_retry(self, html_content: str, source_state: str) -> Dict[str, Any]:
         """Extract with retry logic"""
-        import asyncio
-        
         for attempt in range(self.MAX_RETRIES):
             try:
-                result = self.extractor.extract(html_content, source_state)
+                result = await self.extractor.extract(html_content, source_state)
                 return result
                 
-            except ExtractionError as e:
+            except EngineError as e:
                 if attempt < self.MAX_RETRIES - 1:
                     delay = self.BASE_DELAY_MS * (2 ** attempt) / 1000
                     logger.warning(f"Extraction failed, retrying in {delay}s: {e}")
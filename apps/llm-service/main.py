@@ -1,10 +1,15 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
+import asyncio
+import json
 import logging
+import os
 import time
 from datetime import datetime
-from typing import List
+from typing import Any, AsyncIterator, Dict, List, Tuple
+import torch
+from pydantic import TypeAdapter, ValidationError
 
 from schemas import (
     ExtractionRequest,
@@ -12,7 +17,13 @@ from schemas import (
     MissingPersonExtractionSchema,
     HealthResponse,
 )
-from extractor import QwenExtractor, ExtractionError, ExtractionWithRetry
+from extractor import (
+    QwenExtractor,
+    HFQwenExtractor,
+    ExtractionBatcher,
+    ExtractionError,
+    ExtractionWithRetry,
+)
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
@@ -20,19 +31,63 @@ logger = logging.getLogger(__name__)
 
 # Global state
 extractor: QwenExtractor = None
+batcher: ExtractionBatcher = None
 extractor_with_retry: ExtractionWithRetry = None
 start_time: float = time.time()
 
+# Compiled once; validates a whole list of records in a single call
+_LIST_ADAPTER = TypeAdapter(List[MissingPersonExtractionSchema])
+
+
+def _validate_records(
+    records: List[Dict[str, Any]],
+) -> Tuple[List[MissingPersonExtractionSchema], List[dict]]:
+    """
+    Validate extracted records against the schema
+    
+    Returns the valid records and, for each rejected record, its index in
+    the input list together with its validation errors.
+    """
+    try:
+        return _LIST_ADAPTER.validate_python(records, strict=False), []
+    except ValidationError as e:
+        errors = e.errors(include_url=False, include_context=False)
+    
+    failed: Dict[int, List[dict]] = {}
+    for error in errors:
+        loc = error["loc"]
+        if not loc or not isinstance(loc[0], int):
+            # Not a list at all, nothing salvageable
+            return [], [{"index": None, "errors": errors}]
+        failed.setdefault(loc[0], []).append(error)
+    
+    for index, index_errors in failed.items():
+        logger.warning(f"Failed to validate record {index}: {index_errors}")
+    
+    valid = [record for i, record in enumerate(records) if i not in failed]
+    failed_extractions = [
+        {"index": index, "errors": index_errors}
+        for index, index_errors in sorted(failed.items())
+    ]
+    return _LIST_ADAPTER.validate_python(valid, strict=False), failed_extractions
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize and cleanup resources"""
-    global extractor, extractor_with_retry
+    global extractor, batcher, extractor_with_retry
     
     logger.info("Starting LLM service...")
     try:
-        extractor = QwenExtractor(model_name="Qwen2.5-7B-Instruct")
-        extractor_with_retry = ExtractionWithRetry(extractor)
+        if os.getenv("LLM_BACKEND", "vllm") == "hf":
+            extractor = HFQwenExtractor(model_name="Qwen/Qwen2.5-7B-Instruct")
+        else:
+            extractor = QwenExtractor(model_name="Qwen/Qwen2.5-7B-Instruct-AWQ")
+        batcher = ExtractionBatcher(extractor)
+        batcher.start()
+        extractor_with_retry = ExtractionWithRetry(batcher)
+        await extractor.warmup()
+        prefix_refresh = asyncio.create_task(extractor.keep_prefix_warm())
         logger.info("✓ LLM service initialized")
     except Exception as e:
         logger.error(f"✗ Failed to initialize LLM: {e}")
@@ -41,6 +96,8 @@ async def lifespan(app: FastAPI):
     yield
     
     logger.info("Shutting down LLM service...")
+    prefix_refresh.cancel()
+    await batcher.stop()
 
 
 # Create FastAPI app
@@ -55,8 +112,6 @@ app = FastAPI(
 @app.get("/api/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint"""
-    import torch
-    
     return HealthResponse(
         status="healthy",
         model_loaded=extractor is not None,
@@ -80,42 +135,40 @@ async def extract_missing_persons(request: ExtractionRequest) -> ExtractionRespo
     if extractor is None:
         raise HTTPException(status_code=503, detail="LLM service not initialized")
     
+    t0 = time.perf_counter_ns()
+    
     try:
-        start_time_ms = time.time() * 1000
-        
         # Extract with retry
         result = await extractor_with_retry.extract_with_retry(
             html_content=request.html_content,
             source_state=request.source_state,
         )
         
-        processing_time_ms = time.time() * 1000 - start_time_ms
+        processing_time_ms = (time.perf_counter_ns() - t0) / 1e6
         
         # Convert to response schema
-        extracted_records: List[MissingPersonExtractionSchema] = []
-        for record in result["records"]:
-            try:
-                extracted_records.append(
-                    MissingPersonExtractionSchema(**record)
-                )
-            except Exception as e:
-                logger.warning(f"Failed to validate record: {e}")
-                continue
+        extracted_records, failed_extractions = _validate_records(result["records"])
         
         return ExtractionResponse(
             success=True,
             extracted_records=extracted_records,
+            failed_extractions=failed_extractions,
             extraction_confidence=result["confidence_scores"][:len(extracted_records)],
             processing_time_ms=processing_time_ms,
-            model_used="Qwen2.5-7B-Instruct",
-            message=f"Successfully extracted {len(extracted_records)} records",
+            model_used=extractor.model_name,
+            truncated=result["truncated"],
+            message=(
+                f"Successfully extracted {len(extracted_records)} records"
+                + (" (output truncated, some records may be missing)" if result["truncated"] else "")
+            ),
         )
         
     except ExtractionError as e:
         logger.error(f"Extraction error: {e}")
         return ExtractionResponse(
             success=False,
-            processing_time_ms=(time.time() * 1000 - start_time_ms),
+            processing_time_ms=(time.perf_counter_ns() - t0) / 1e6,
+            model_used=extractor.model_name,
             message=f"Extraction failed: {str(e)}",
         )
     except Exception as e:
@@ -123,12 +176,50 @@ async def extract_missing_persons(request: ExtractionRequest) -> ExtractionRespo
         raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
 
 
+@app.post("/api/extract/stream")
+async def stream_missing_persons(request: ExtractionRequest) -> StreamingResponse:
+    """
+    Extract missing person data from HTML, streaming records as ND-JSON
+    
+    Each validated record is written as its own line as soon as the model
+    finishes generating it, instead of after the whole array is decoded.
+    A rejected record is written as {"failed_extraction": {"index", "errors"}}
+    (same shape as failed_extractions on /api/extract), and a failure ends
+    the stream with an {"error": ...} line, since the 200 status has
+    already been sent by then.
+    """
+    if extractor is None:
+        raise HTTPException(status_code=503, detail="LLM service not initialized")
+    
+    async def _iter() -> AsyncIterator[str]:
+        index = 0
+        try:
+            async for record in extractor.stream_records(request.html_content):
+                try:
+                    validated = MissingPersonExtractionSchema.model_validate(record)
+                except ValidationError as e:
+                    logger.warning(f"Failed to validate streamed record {index}: {e}")
+                    failed = {
+                        "index": index,
+                        "errors": e.errors(include_url=False, include_context=False),
+                    }
+                    yield json.dumps({"failed_extraction": failed}, default=str) + "\n"
+                else:
+                    yield validated.model_dump_json() + "\n"
+                index += 1
+        except Exception as e:
+            logger.error(f"Streaming extraction error: {e}")
+            yield json.dumps({"error": f"Extraction failed: {e}"}) + "\n"
+    
+    return StreamingResponse(_iter(), media_type="application/x-ndjson")
+
+
 @app.get("/api/stats")
 async def get_stats():
     """Get service statistics"""
     return {
         "uptime_seconds": time.time() - start_time,
-        "model": "Qwen2.5-7B-Instruct",
+        "model": extractor.model_name if extractor is not None else None,
         "status": "running",
         "timestamp": datetime.now(),
     }
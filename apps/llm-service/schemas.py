@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, field_validator
-from typing import Optional, List
+from typing import Any, Literal, Optional, List
 from datetime import datetime
 from enum import Enum
 
@@ -10,6 +10,9 @@ class GenderEnum(str, Enum):
     OTHER = "other"
 
 
+_GENDER_VALUES = {g.value for g in GenderEnum}
+
+
 class StatusEnum(str, Enum):
     MISSING = "missing"
     FOUND = "found"
@@ -17,7 +20,7 @@ class StatusEnum(str, Enum):
 
 class CoordinatesSchema(BaseModel):
     """GeoJSON Point coordinates"""
-    type: str = Field("Point", const=True)
+    type: Literal["Point"] = "Point"
     coordinates: tuple[float, float] = Field(
         ..., description="[longitude, latitude]"
     )
@@ -62,6 +65,16 @@ class MissingPersonExtractionSchema(BaseModel):
     contact_name: Optional[str] = Field(None, max_length=255)
     contact_phone: Optional[str] = None
 
+    @field_validator("gender", mode="before")
+    @classmethod
+    def normalize_gender(cls, v: Any) -> Any:
+        """Map unrecognised or missing (null) gender values to "other" instead of rejecting"""
+        if isinstance(v, str):
+            v = v.strip().lower()
+            if v in _GENDER_VALUES:
+                return v
+        return GenderEnum.OTHER
+
     class Config:
         json_schema_extra = {
             "example": {
@@ -90,6 +103,9 @@ class ExtractionResponse(BaseModel):
     )
     processing_time_ms: float
     model_used: str = "Qwen2.5-7B-Instruct"
+    truncated: bool = Field(
+        False, description="Model output hit the token limit; records may be missing"
+    )
     message: str = ""
 
     class Config: